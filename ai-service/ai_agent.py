@@ -1,11 +1,23 @@
 # ai_agent_service.py
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Depends, Header
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
+from collections import deque, namedtuple
+from contextlib import contextmanager
 import os
-from datetime import datetime
+import sys
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import itertools
+import json
+from datetime import datetime, timedelta
 import time
+import threading
+import tracemalloc
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -29,6 +41,17 @@ except Exception as e:
     print(f"Warning: Could not import TavilySearchResults: {e}")
     TavilySearchResults = None
 
+# Kafka is only needed when booking-event pre-generation is enabled
+AIOKafkaConsumer = None
+
+try:
+    from aiokafka import AIOKafkaConsumer, TopicPartition
+except Exception as e:
+    print(f"Warning: Could not import aiokafka: {e}")
+    AIOKafkaConsumer = None
+    # Same shape as aiokafka's, so consumer stand-ins can still be driven
+    TopicPartition = namedtuple("TopicPartition", ["topic", "partition"])
+
 import mysql.connector
 from mysql.connector import pooling
 
@@ -144,6 +167,272 @@ if ChatOpenAI and openai_api_key:
 else:
     llm = None
 
+# Per-request deadlines (stay under the backend proxy's 60 s cutoff by default)
+request_timeout_ms = int(os.getenv("AI_REQUEST_TIMEOUT_MS", "55000"))
+llm_timeout = float(os.getenv("AI_LLM_TIMEOUT", "45"))
+search_timeout = float(os.getenv("AI_SEARCH_TIMEOUT", "8"))
+db_timeout = float(os.getenv("AI_DB_TIMEOUT", "5"))
+search_hedge_delay = float(os.getenv("AI_SEARCH_HEDGE_DELAY", "1.5"))
+search_hedge_attempts = int(os.getenv("AI_SEARCH_HEDGE_ATTEMPTS", "2"))
+disconnect_poll_interval = float(os.getenv("AI_DISCONNECT_POLL_INTERVAL", "0.5"))
+
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+# In-flight requests and their current stage, for the diagnostics dump
+in_flight_requests = {}
+request_ids = itertools.count(1)
+current_request = contextvars.ContextVar("current_request", default=None)
+
+@contextmanager
+def track_request(label: str):
+    """Register a request in the in-flight table while it runs"""
+    entry = {"id": next(request_ids), "label": label, "stage": "started",
+             "started_at": time.time(), "started": time.monotonic()}
+    in_flight_requests[entry["id"]] = entry
+    token = current_request.set(entry)
+    try:
+        yield entry
+    finally:
+        current_request.reset(token)
+        in_flight_requests.pop(entry["id"], None)
+
+def set_stage(stage: str):
+    """Record what the current request is doing"""
+    entry = current_request.get()
+    if entry is not None:
+        entry["stage"] = stage
+
+class DeadlineExceeded(Exception):
+    """The caller's time budget ran out"""
+
+class LLMUnavailable(Exception):
+    """No LLM response, and the caller cannot use the basic fallback plan"""
+
+class CircuitBreaker:
+    """Skip an upstream after repeated failures until it has had time to recover"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    @property
+    def probe_in_flight(self):
+        """Whether another call is already probing the half-open upstream"""
+        # A probe that never reported back (e.g. cancelled) is replaced after reset_timeout
+        return (self.state == "half_open" and self.probe_started is not None
+                and time.monotonic() - self.probe_started < self.reset_timeout)
+
+    @property
+    def available(self):
+        """Whether allow() would let a call through, without claiming the probe"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probe_in_flight)
+
+    def allow(self):
+        """Whether a call may go through; half-open lets a single call probe the upstream"""
+        if not self.available:
+            return False
+        if self.state == "half_open":
+            self.probe_started = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.probe_started = None
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"[Breaker] {self.name} circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+breaker_threshold = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "3"))
+breaker_reset_timeout = float(os.getenv("AI_BREAKER_RESET_TIMEOUT", "30"))
+llm_breaker = CircuitBreaker("openai", breaker_threshold, breaker_reset_timeout)
+search_breaker = CircuitBreaker("tavily", breaker_threshold, breaker_reset_timeout)
+
+def remaining_budget():
+    """Seconds left before the current request's deadline, or None without one"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def call_timeout(cap: float):
+    """Timeout for one upstream call: its own cap, bounded by the request budget"""
+    remaining = remaining_budget()
+    if remaining is None:
+        return cap
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(cap, remaining)
+
+def check_deadline():
+    """Raise when a timed-out call actually ran out the request budget"""
+    remaining = remaining_budget()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+
+async def call_db(func, *args, fallback=None, **kwargs):
+    """
+    Run a blocking database helper off the event loop within the request budget.
+    A slow query gets the helper's usual fallback; only an exhausted budget raises.
+    """
+    set_stage(f"db:{func.__name__}")
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), call_timeout(db_timeout))
+    except asyncio.TimeoutError:
+        check_deadline()
+        print(f"Database call {func.__name__} timed out after {db_timeout}s")
+        return fallback
+
+def limit_query_time(cursor):
+    """Have MySQL itself stop statements that outlive the DB timeout or request budget"""
+    remaining = remaining_budget()
+    seconds = db_timeout if remaining is None else max(min(db_timeout, remaining), 0.001)
+    try:
+        cursor.execute(
+            "SET SESSION MAX_EXECUTION_TIME = %s, SESSION innodb_lock_wait_timeout = %s",
+            (int(seconds * 1000) or 1, max(int(seconds), 1))
+        )
+    except Exception as e:
+        print(f"Could not set query time limit: {e}")
+
+async def invoke_llm(messages):
+    """Call the LLM within the request budget; None when it is unavailable"""
+    if not llm or not llm_breaker.allow():
+        return None
+
+    set_stage("llm")
+    try:
+        response = await asyncio.wait_for(llm.ainvoke(messages), call_timeout(llm_timeout))
+        llm_breaker.record_success()
+        return response
+    except asyncio.TimeoutError:
+        check_deadline()
+        print(f"LLM call timed out after {llm_timeout}s")
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        print(f"LLM error: {e}")
+    llm_breaker.record_failure()
+    return None
+
+async def hedged_search(query: str):
+    """Search Tavily, starting a backup attempt when the first one is slow or fails"""
+    if not search_tool or not search_breaker.allow():
+        return None
+
+    set_stage("search")
+    end = time.monotonic() + call_timeout(search_timeout)
+    started = 0
+    pending = set()
+    try:
+        while True:
+            # Start the first attempt, or a hedge when the previous one is slow or failed
+            if started < search_hedge_attempts:
+                pending.add(asyncio.create_task(search_tool.ainvoke({"query": query})))
+                started += 1
+
+            remaining = end - time.monotonic()
+            if remaining <= 0 or not pending:
+                break
+            wait = min(remaining, search_hedge_delay) if started < search_hedge_attempts else remaining
+            done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if task.exception() is None:
+                    search_breaker.record_success()
+                    return task.result()
+                print(f"Tavily attempt failed: {task.exception()}")
+    finally:
+        for task in pending:
+            task.cancel()
+
+    check_deadline()
+    print(f"Tavily search gave no result after {started} attempts")
+    search_breaker.record_failure()
+    return None
+
+# Plan pre-generation from booking events (off unless AI_PREGEN_ENABLED=true)
+pregen_enabled = os.getenv("AI_PREGEN_ENABLED", "false").lower() == "true"
+kafka_brokers = [b.strip() for b in os.getenv("KAFKA_BROKER", "localhost:9092").split(",") if b.strip()]
+kafka_booking_topic = os.getenv("KAFKA_BOOKING_TOPIC", "booking-notifications")
+pregen_group_id = os.getenv("AI_PREGEN_GROUP_ID", "ai-service-pregen")
+pregen_events = {e.strip() for e in os.getenv("AI_PREGEN_EVENTS", "booking_created,booking_accepted").split(",") if e.strip()}
+pregen_concurrency = int(os.getenv("AI_PREGEN_CONCURRENCY", "1"))
+pregen_queue_size = int(os.getenv("AI_PREGEN_QUEUE_SIZE", "100"))
+# Pre-generation waits while this many interactive requests are in flight (0 = no limit)
+pregen_max_interactive = int(os.getenv("AI_PREGEN_MAX_INTERACTIVE", "1"))
+pregen_max_lag = int(os.getenv("AI_PREGEN_MAX_LAG", "500"))
+
+pregen_stats = {
+    "events_consumed": 0,
+    "events_skipped": 0,
+    "plans_generated": 0,
+    "plans_failed": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "interactive_in_flight": 0,
+    "consumer_lag": {},
+}
+pregen_completed_at = deque(maxlen=1000)
+pregen_queue = None
+pregen_tasks = []
+pregen_consumer = None
+# Per partition: offsets still being processed and the next offset after the last one read
+pregen_offsets = {}
+
+async def run_interactive(http_request: Request, handler):
+    """
+    Run an interactive request handler under the caller's deadline, cancelling it
+    if the client disconnects. Background pre-generation yields while it runs.
+    """
+    # The header can only shorten the default budget
+    budget = request_timeout_ms / 1000
+    try:
+        requested_ms = int(http_request.headers.get("x-request-timeout-ms", ""))
+    except ValueError:
+        requested_ms = 0
+    if 0 < requested_ms < request_timeout_ms:
+        budget = requested_ms / 1000
+    request_deadline.set(time.monotonic() + budget)
+
+    pregen_stats["interactive_in_flight"] += 1
+    with track_request(f"{http_request.method} {http_request.url.path}"):
+        task = asyncio.create_task(handler)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=min(disconnect_poll_interval, max(remaining_budget(), 0)))
+                if done:
+                    return task.result()
+                if remaining_budget() <= 0:
+                    raise DeadlineExceeded()
+                if await http_request.is_disconnected():
+                    print(f"Client disconnected, cancelling {http_request.url.path}")
+                    raise HTTPException(status_code=499, detail="Client disconnected")
+        except DeadlineExceeded:
+            print(f"Deadline of {budget:.1f}s exceeded for {http_request.url.path}")
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        finally:
+            task.cancel()
+            pregen_stats["interactive_in_flight"] -= 1
+
 def get_booking_details(booking_id: int):
     """Fetch booking details from database"""
     if not connection_pool:
@@ -152,6 +441,7 @@ def get_booking_details(booking_id: int):
     try:
         connection = connection_pool.get_connection()
         cursor = connection.cursor(dictionary=True)
+        limit_query_time(cursor)
 
         query = """
         SELECT b.*, p.property_name, p.location, p.amenities
@@ -178,6 +468,7 @@ def save_conversation_message(user_id: int, message: str, role: str):
     try:
         connection = connection_pool.get_connection()
         cursor = connection.cursor()
+        limit_query_time(cursor)
 
         # Create table if it doesn't exist
         cursor.execute("""
@@ -211,6 +502,7 @@ def get_conversation_history(user_id: int, limit: int = 10):
     try:
         connection = connection_pool.get_connection()
         cursor = connection.cursor(dictionary=True)
+        limit_query_time(cursor)
 
         query = """
         SELECT message, role, created_at
@@ -239,6 +531,7 @@ def get_owner_properties(user_id: int):
     try:
         connection = connection_pool.get_connection()
         cursor = connection.cursor(dictionary=True)
+        limit_query_time(cursor)
 
         query = """
         SELECT id, property_name, property_type, location, city, state,
@@ -259,61 +552,107 @@ def get_owner_properties(user_id: int):
         print(f"Error fetching owner properties: {e}")
         return []
 
-def search_local_pois(location: str, interests: List[str]):
-    """Search for local points of interest"""
-    if not search_tool:
-        return []
-    
+def plan_cache_key(request: AgentRequestModel):
+    """Fingerprint the inputs that shape a travel plan"""
+    ctx = request.booking_context
+    payload = {
+        "start_date": ctx.start_date.split('T')[0],
+        "end_date": ctx.end_date.split('T')[0],
+        "number_of_guests": ctx.number_of_guests,
+        "preferences": request.preferences.model_dump(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def get_stored_plan(booking_id: int, cache_key: str):
+    """Fetch a previously generated plan for a booking"""
+    if not connection_pool or not booking_id:
+        return None
+
     try:
-        query = f"top tourist attractions and activities in {location}"
-        if interests:
-            query += f" for {', '.join(interests)}"
-        
-        results = search_tool.invoke({"query": query})
-        return results
+        connection = connection_pool.get_connection()
+        cursor = connection.cursor(dictionary=True)
+        limit_query_time(cursor)
+
+        query = """
+        SELECT plan_json
+        FROM ai_trip_plans
+        WHERE booking_id = %s AND request_hash = %s
+        """
+        cursor.execute(query, (booking_id, cache_key))
+        result = cursor.fetchone()
+
+        cursor.close()
+        connection.close()
+
+        if not result:
+            return None
+        return AgentResponse.model_validate_json(result["plan_json"])
     except Exception as e:
-        print(f"Error searching POIs: {e}")
-        return []
+        print(f"Error fetching stored plan: {e}")
+        return None
+
+def save_trip_plan(booking_id: int, cache_key: str, plan: AgentResponse):
+    """Store a pre-generated plan so later requests can return it immediately"""
+    if not connection_pool or not booking_id:
+        return False
 
-def search_weather(location: str, dates: str):
-    """Search for weather information"""
-    if not search_tool:
-        return "Weather information unavailable"
-    
     try:
-        query = f"weather forecast {location} {dates}"
-        results = search_tool.invoke({"query": query})
-        return results
+        connection = connection_pool.get_connection()
+        cursor = connection.cursor()
+        limit_query_time(cursor)
+
+        # Create table if it doesn't exist
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ai_trip_plans (
+                booking_id INT NOT NULL,
+                request_hash CHAR(64) NOT NULL,
+                plan_json MEDIUMTEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (booking_id, request_hash),
+                FOREIGN KEY (booking_id) REFERENCES bookings(id) ON DELETE CASCADE
+            )
+        """)
+
+        query = """
+        INSERT INTO ai_trip_plans (booking_id, request_hash, plan_json)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE plan_json = VALUES(plan_json), created_at = CURRENT_TIMESTAMP
+        """
+        cursor.execute(query, (booking_id, cache_key, plan.model_dump_json()))
+        connection.commit()
+
+        cursor.close()
+        connection.close()
+
+        return True
     except Exception as e:
-        print(f"Error searching weather: {e}")
-        return "Weather information unavailable"
+        print(f"Error saving trip plan: {e}")
+        return False
+
+async def search_local_pois(location: str, interests: List[str]):
+    """Search for local points of interest"""
+    query = f"top tourist attractions and activities in {location}"
+    if interests:
+        query += f" for {', '.join(interests)}"
+
+    results = await hedged_search(query)
+    return results or []
+
+async def search_weather(location: str, dates: str):
+    """Search for weather information"""
+    results = await hedged_search(f"weather forecast {location} {dates}")
+    return results or "Weather information unavailable"
 
-def search_restaurants(location: str, dietary_filters: List[str]):
+async def search_restaurants(location: str, dietary_filters: List[str]):
     """Search for restaurants based on dietary needs"""
-    if not search_tool:
-        return []
-    
-    try:
-        dietary_str = ", ".join(dietary_filters) if dietary_filters else "best"
-        query = f"{dietary_str} restaurants in {location}"
-        results = search_tool.invoke({"query": query})
-        return results
-    except Exception as e:
-        print(f"Error searching restaurants: {e}")
-        return []
+    dietary_str = ", ".join(dietary_filters) if dietary_filters else "best"
+    results = await hedged_search(f"{dietary_str} restaurants in {location}")
+    return results or []
 
-def search_local_events(location: str, dates: str):
+async def search_local_events(location: str, dates: str):
     """Search for local events"""
-    if not search_tool:
-        return []
-    
-    try:
-        query = f"events and festivals in {location} during {dates}"
-        results = search_tool.invoke({"query": query})
-        return results
-    except Exception as e:
-        print(f"Error searching events: {e}")
-        return []
+    results = await hedged_search(f"events and festivals in {location} during {dates}")
+    return results or []
 
 def generate_packing_list(weather_info: str, activities: List[str], duration: int):
     """Generate weather-aware packing checklist"""
@@ -347,39 +686,36 @@ def generate_packing_list(weather_info: str, activities: List[str], duration: in
     
     return list(set(base_items))  # Remove duplicates
 
-@app.post("/api/agent/plan", response_model=AgentResponse)
-async def create_travel_plan(request: AgentRequestModel):
-    """
-    Generate a personalized travel plan based on booking and preferences
-    """
-    try:
-        # Get booking details from database
-        booking = get_booking_details(request.booking_context.booking_id)
+async def generate_travel_plan(request: AgentRequestModel, require_llm: bool = False):
+    """Build a travel plan for a booking; shared by the API and pre-generation"""
+    # Get booking details from database
+    booking = await call_db(get_booking_details, request.booking_context.booking_id)
 
-        if not booking:
-            location = request.booking_context.location
-        else:
-            location = booking["location"]
+    if not booking:
+        location = request.booking_context.location
+    else:
+        location = booking["location"]
 
-        # Calculate duration - handle both ISO format and simple date format
-        start_date_str = request.booking_context.start_date.split('T')[0] if 'T' in request.booking_context.start_date else request.booking_context.start_date
-        end_date_str = request.booking_context.end_date.split('T')[0] if 'T' in request.booking_context.end_date else request.booking_context.end_date
+    # Calculate duration - handle both ISO format and simple date format
+    start_date_str = request.booking_context.start_date.split('T')[0] if 'T' in request.booking_context.start_date else request.booking_context.start_date
+    end_date_str = request.booking_context.end_date.split('T')[0] if 'T' in request.booking_context.end_date else request.booking_context.end_date
 
-        start = datetime.strptime(start_date_str, "%Y-%m-%d")
-        end = datetime.strptime(end_date_str, "%Y-%m-%d")
-        duration = (end - start).days
+    start = datetime.strptime(start_date_str, "%Y-%m-%d")
+    end = datetime.strptime(end_date_str, "%Y-%m-%d")
+    duration = (end - start).days
 
-        date_range = f"{request.booking_context.start_date} to {request.booking_context.end_date}"
+    date_range = f"{request.booking_context.start_date} to {request.booking_context.end_date}"
 
-        # Use OpenAI to generate intelligent recommendations if available
-        if llm:
-            from langchain_core.messages import HumanMessage
-            import json
+    # Use OpenAI to generate intelligent recommendations if available
+    response = None
+    if llm and llm_breaker.available:
+        from langchain_core.messages import HumanMessage
 
-            interests_str = ', '.join(request.preferences.interests) if request.preferences.interests else 'general sightseeing'
-            dietary_str = ', '.join(request.preferences.dietary_filters) if request.preferences.dietary_filters else 'no restrictions'
+        set_stage("build_prompt")
+        interests_str = ', '.join(request.preferences.interests) if request.preferences.interests else 'general sightseeing'
+        dietary_str = ', '.join(request.preferences.dietary_filters) if request.preferences.dietary_filters else 'no restrictions'
 
-            prompt = f"""You are a travel planning expert. Create a detailed {duration}-day itinerary for {location}.
+        prompt = f"""You are a travel planning expert. Create a detailed {duration}-day itinerary for {location}.
 
 Trip Details:
 - Location: {location}
@@ -418,108 +754,132 @@ Format your response as JSON with this structure:
 
 Be specific! Use real places, cafes, hiking trails, museums, etc. based on the interests."""
 
-            t0 = time.time()
-            response = llm.invoke([HumanMessage(content=prompt)])
-            t1 = time.time()
-            print(f"LLM invoke (plan) took {(t1-t0):.2f}s")
-
-            try:
-                # Try to parse JSON from response
-                content = response.content
-                # Find JSON in the response (might be wrapped in markdown)
-                if "```json" in content:
-                    content = content.split("```json")[1].split("```")[0]
-                elif "```" in content:
-                    content = content.split("```")[1].split("```")[0]
-
-                ai_plan = json.loads(content.strip())
-
-                # Convert AI response to our data models
-                day_plans = []
-                for day_data in ai_plan.get("days", [])[:duration]:
-                    day_num = day_data.get("day", len(day_plans) + 1)
-                    day_date = start + timedelta(days=day_num - 1)
-
-                    morning = day_data.get("morning", {})
-                    afternoon = day_data.get("afternoon", {})
-                    evening = day_data.get("evening", {})
-
-                    day_plans.append(DayPlan(
-                        day=day_num,
-                        date=day_date.strftime("%Y-%m-%d"),
-                        morning=[ActivityCard(
-                            title=morning.get("title", f"Morning Activity {day_num}"),
-                            address=morning.get("address", location),
-                            price_tier=request.preferences.budget,
-                            duration=morning.get("duration", "2-3 hours"),
-                            tags=request.preferences.interests[:2] if request.preferences.interests else ["sightseeing"],
-                            wheelchair_friendly=True,
-                            child_friendly=True
-                        )],
-                        afternoon=[ActivityCard(
-                            title=afternoon.get("title", f"Afternoon Activity {day_num}"),
-                            address=afternoon.get("address", location),
-                            price_tier=request.preferences.budget,
-                            duration=afternoon.get("duration", "3-4 hours"),
-                            tags=request.preferences.interests if request.preferences.interests else ["culture"],
-                            wheelchair_friendly=True,
-                            child_friendly=True
-                        )],
-                        evening=[ActivityCard(
-                            title=evening.get("title", f"Evening Activity {day_num}"),
-                            address=evening.get("address", location),
-                            price_tier=request.preferences.budget,
-                            duration=evening.get("duration", "2-3 hours"),
-                            tags=["dining", "entertainment"],
-                            wheelchair_friendly=True,
-                            child_friendly=True
-                        )]
-                    ))
-
-                # Convert restaurant recommendations
-                restaurant_recs = []
-                for rest in ai_plan.get("restaurants", [])[:5]:
-                    restaurant_recs.append(RestaurantRec(
-                        name=rest.get("name", "Local Restaurant"),
-                        cuisine=rest.get("cuisine", "Local Cuisine"),
-                        address=rest.get("address", location),
+        t0 = time.time()
+        response = await invoke_llm([HumanMessage(content=prompt)])
+        t1 = time.time()
+        print(f"LLM invoke (plan) took {(t1-t0):.2f}s")
+
+    if response is not None:
+        set_stage("parse_plan")
+        try:
+            # Try to parse JSON from response
+            content = response.content
+            # Find JSON in the response (might be wrapped in markdown)
+            if "```json" in content:
+                content = content.split("```json")[1].split("```")[0]
+            elif "```" in content:
+                content = content.split("```")[1].split("```")[0]
+
+            ai_plan = json.loads(content.strip())
+
+            # Convert AI response to our data models
+            day_plans = []
+            for day_data in ai_plan.get("days", [])[:duration]:
+                day_num = day_data.get("day", len(day_plans) + 1)
+                day_date = start + timedelta(days=day_num - 1)
+
+                morning = day_data.get("morning", {})
+                afternoon = day_data.get("afternoon", {})
+                evening = day_data.get("evening", {})
+
+                day_plans.append(DayPlan(
+                    day=day_num,
+                    date=day_date.strftime("%Y-%m-%d"),
+                    morning=[ActivityCard(
+                        title=morning.get("title", f"Morning Activity {day_num}"),
+                        address=morning.get("address", location),
                         price_tier=request.preferences.budget,
-                        dietary_tags=rest.get("dietary", request.preferences.dietary_filters)
-                    ))
-
-                packing_list = ai_plan.get("packing", [])
-                summary = ai_plan.get("summary", f"Your {duration}-day trip to {location} is planned!")
-
-            except Exception as e:
-                print(f"Error parsing AI response: {e}")
-                # Fallback to basic plan
-                day_plans = []
-                restaurant_recs = []
-                packing_list = generate_packing_list("", request.preferences.interests, duration)
-                summary = f"Basic {duration}-day itinerary for {location}"
-        else:
-            # Fallback when OpenAI is not available
+                        duration=morning.get("duration", "2-3 hours"),
+                        tags=request.preferences.interests[:2] if request.preferences.interests else ["sightseeing"],
+                        wheelchair_friendly=True,
+                        child_friendly=True
+                    )],
+                    afternoon=[ActivityCard(
+                        title=afternoon.get("title", f"Afternoon Activity {day_num}"),
+                        address=afternoon.get("address", location),
+                        price_tier=request.preferences.budget,
+                        duration=afternoon.get("duration", "3-4 hours"),
+                        tags=request.preferences.interests if request.preferences.interests else ["culture"],
+                        wheelchair_friendly=True,
+                        child_friendly=True
+                    )],
+                    evening=[ActivityCard(
+                        title=evening.get("title", f"Evening Activity {day_num}"),
+                        address=evening.get("address", location),
+                        price_tier=request.preferences.budget,
+                        duration=evening.get("duration", "2-3 hours"),
+                        tags=["dining", "entertainment"],
+                        wheelchair_friendly=True,
+                        child_friendly=True
+                    )]
+                ))
+
+            # Convert restaurant recommendations
+            restaurant_recs = []
+            for rest in ai_plan.get("restaurants", [])[:5]:
+                restaurant_recs.append(RestaurantRec(
+                    name=rest.get("name", "Local Restaurant"),
+                    cuisine=rest.get("cuisine", "Local Cuisine"),
+                    address=rest.get("address", location),
+                    price_tier=request.preferences.budget,
+                    dietary_tags=rest.get("dietary", request.preferences.dietary_filters)
+                ))
+
+            packing_list = ai_plan.get("packing", [])
+            summary = ai_plan.get("summary", f"Your {duration}-day trip to {location} is planned!")
+
+        except Exception as e:
+            print(f"Error parsing AI response: {e}")
+            # Fallback to basic plan
             day_plans = []
             restaurant_recs = []
             packing_list = generate_packing_list("", request.preferences.interests, duration)
-            summary = f"Your {duration}-day trip to {location}"
-
-        return AgentResponse(
-            day_plans=day_plans,
-            restaurant_recommendations=restaurant_recs,
-            packing_checklist=packing_list,
-            summary=summary.strip()
-        )
-        
+            summary = f"Basic {duration}-day itinerary for {location}"
+    elif require_llm:
+        raise LLMUnavailable(f"No LLM response for booking {request.booking_context.booking_id}")
+    else:
+        # Fallback when OpenAI is not available or its circuit is open
+        day_plans = []
+        restaurant_recs = []
+        packing_list = generate_packing_list("", request.preferences.interests, duration)
+        summary = f"Your {duration}-day trip to {location}"
+
+    return AgentResponse(
+        day_plans=day_plans,
+        restaurant_recommendations=restaurant_recs,
+        packing_checklist=packing_list,
+        summary=summary.strip()
+    )
+
+async def serve_travel_plan(request: AgentRequestModel):
+    """Return the pre-generated plan for a booking, or generate a new one"""
+    try:
+        # Return the plan pre-generated from the booking event when the inputs match
+        booking_id = request.booking_context.booking_id
+        cache_key = plan_cache_key(request)
+        stored_plan = await call_db(get_stored_plan, booking_id, cache_key)
+        if stored_plan:
+            pregen_stats["cache_hits"] += 1
+            return stored_plan
+        pregen_stats["cache_misses"] += 1
+
+        return await generate_travel_plan(request)
+
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"Error creating travel plan: {e}")
         raise HTTPException(status_code=500, detail=f"Error creating travel plan: {str(e)}")
 
-@app.post("/api/agent/query")
-async def handle_custom_query(request: AgentRequestModel):
+@app.post("/api/agent/plan", response_model=AgentResponse)
+async def create_travel_plan(request: AgentRequestModel, http_request: Request):
     """
-    Handle natural language queries from users
+    Generate a personalized travel plan based on booking and preferences
     """
+    return await run_interactive(http_request, serve_travel_plan(request))
+
+async def answer_custom_query(request: AgentRequestModel):
+    """Answer a chat query with the LLM, falling back when it is unavailable"""
     try:
         # Debug logging
         print(f"========== DEBUG ==========")
@@ -536,14 +896,14 @@ async def handle_custom_query(request: AgentRequestModel):
         number_of_guests = request.booking_context.number_of_guests
 
         # Use OpenAI with optional Tavily search
-        if llm:
+        if llm and llm_breaker.available:
             # Use OpenAI directly when Tavily is not available
             from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
             # Get conversation history for this user
             conversation_history = []
             if request.user_id:
-                history = get_conversation_history(request.user_id, limit=10)
+                history = await call_db(get_conversation_history, request.user_id, limit=10, fallback=[])
                 for msg in history:
                     if msg['role'] == 'user':
                         conversation_history.append(HumanMessage(content=msg['message']))
@@ -551,13 +911,14 @@ async def handle_custom_query(request: AgentRequestModel):
                         conversation_history.append(AIMessage(content=msg['message']))
 
             # Build context-aware system message
+            set_stage("build_prompt")
             user_name = request.user_name or "there"
             user_type = request.user_type or "guest"
 
             # Create context based on user type
             if user_type == "owner":
                 # Fetch owner's properties
-                owner_properties = get_owner_properties(request.user_id) if request.user_id else []
+                owner_properties = await call_db(get_owner_properties, request.user_id, fallback=[]) if request.user_id else []
 
                 # Format properties for context
                 properties_info = ""
@@ -631,11 +992,11 @@ Provide helpful and friendly responses."""
 
             # Try to get real-time information from Tavily if available
             search_context = ""
-            if search_tool:
+            if search_tool and search_breaker.available:
                 try:
                     print(f"Searching Tavily for: {request.custom_query} in {location}")
                     t0 = time.time()
-                    search_results = search_tool.invoke({"query": f"{request.custom_query} in {location}"})
+                    search_results = await hedged_search(f"{request.custom_query} in {location}")
                     t1 = time.time()
                     print(f"Tavily search took {(t1-t0):.2f}s")
 
@@ -649,6 +1010,8 @@ Provide helpful and friendly responses."""
                                 url = result.get('url', '')
                                 search_context += f"\n{idx}. {title}\n   {content}\n   Source: {url}\n"
                         print(f"Added {len(search_results[:5])} Tavily search results to context")
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
                     print(f"Tavily search error: {e}")
                     search_context = ""
@@ -667,31 +1030,42 @@ Provide helpful and friendly responses."""
             print(f"Search context added: {len(search_context)} characters")
 
             t0 = time.time()
-            response = llm.invoke(messages)
+            response = await invoke_llm(messages)
             t1 = time.time()
             print(f"LLM invoke (query) took {(t1-t0):.2f}s")
 
-            # Save conversation to database
-            if request.user_id:
-                save_conversation_message(request.user_id, request.custom_query, 'user')
-                save_conversation_message(request.user_id, response.content, 'assistant')
-
-            return {
-                "response": response.content,
-                "results": [],
-                "suggestions": "Feel free to ask me anything else about your trip!"
-            }
-        else:
-            return {
-                "response": "I can help you with your query, but AI functionality is currently unavailable.",
-                "results": [],
-                "suggestions": "Please ensure OpenAI API key is configured."
-            }
+            if response is not None:
+                # Save conversation to database
+                if request.user_id:
+                    await call_db(save_conversation_message, request.user_id, request.custom_query, 'user', fallback=False)
+                    await call_db(save_conversation_message, request.user_id, response.content, 'assistant', fallback=False)
+
+                return {
+                    "response": response.content,
+                    "results": [],
+                    "suggestions": "Feel free to ask me anything else about your trip!"
+                }
+
+        # Fallback when OpenAI is not available or its circuit is open
+        return {
+            "response": "I can help you with your query, but AI functionality is currently unavailable.",
+            "results": [],
+            "suggestions": "Please ensure OpenAI API key is configured."
+        }
             
+    except (HTTPException, DeadlineExceeded):
+        raise
     except Exception as e:
         print(f"Error handling query: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
+@app.post("/api/agent/query")
+async def handle_custom_query(request: AgentRequestModel, http_request: Request):
+    """
+    Handle natural language queries from users
+    """
+    return await run_interactive(http_request, answer_custom_query(request))
+
 @app.get("/api/agent/health")
 async def health_check():
     """Health check endpoint"""
@@ -700,10 +1074,407 @@ async def health_check():
         "message": "AI Concierge Agent is running",
         "tavily_configured": search_tool is not None,
         "llm_configured": llm is not None,
-        "database_configured": connection_pool is not None
+        "database_configured": connection_pool is not None,
+        "pregen_enabled": pregen_running(),
+        "llm_circuit": llm_breaker.state,
+        "tavily_circuit": search_breaker.state
+    }
+
+async def pregenerate_plan(booking_id: int):
+    """Generate and store the default plan for a booking"""
+    request_deadline.set(time.monotonic() + request_timeout_ms / 1000)
+    booking = await call_db(get_booking_details, booking_id)
+    if not booking or booking.get("status") == "CANCELLED":
+        pregen_stats["events_skipped"] += 1
+        return
+
+    request = AgentRequestModel(
+        booking_context=BookingContextModel(
+            booking_id=booking_id,
+            location=booking["location"],
+            start_date=booking["start_date"].strftime("%Y-%m-%d"),
+            end_date=booking["end_date"].strftime("%Y-%m-%d"),
+            number_of_guests=booking["number_of_guests"]
+        ),
+        preferences=PreferencesModel()
+    )
+    cache_key = plan_cache_key(request)
+    if await call_db(get_stored_plan, booking_id, cache_key):
+        pregen_stats["events_skipped"] += 1
+        return
+
+    t0 = time.time()
+    plan = await generate_travel_plan(request, require_llm=True)
+    t1 = time.time()
+
+    if plan.day_plans and await call_db(save_trip_plan, booking_id, cache_key, plan, fallback=False):
+        pregen_stats["plans_generated"] += 1
+        pregen_completed_at.append(t1)
+        print(f"[Pregen] Plan for booking {booking_id} took {(t1-t0):.2f}s")
+    else:
+        pregen_stats["plans_failed"] += 1
+        print(f"[Pregen] No plan stored for booking {booking_id}")
+
+async def commit_pregen_offset(tp):
+    """Commit up to the oldest event on this partition that is still being processed"""
+    offsets = pregen_offsets[tp]
+    position = min(offsets["pending"]) if offsets["pending"] else offsets["next"]
+    if position > offsets["committed"] and hasattr(pregen_consumer, "commit"):
+        try:
+            await pregen_consumer.commit({tp: position})
+            offsets["committed"] = position
+        except Exception as e:
+            print(f"[Pregen] Could not commit offset {position} on {tp.topic}-{tp.partition}: {e}")
+
+async def run_pregen_consumer(consumer):
+    """Queue pre-generation jobs for booking events read from the consumer"""
+    try:
+        async for record in consumer:
+            pregen_stats["events_consumed"] += 1
+            tp = TopicPartition(record.topic, record.partition)
+            offsets = pregen_offsets.setdefault(tp, {"pending": set(), "next": 0, "committed": 0})
+            offsets["next"] = record.offset + 1
+
+            if hasattr(consumer, "highwater"):
+                highwater = consumer.highwater(tp)
+                if highwater is not None:
+                    lag = highwater - record.offset - 1
+                    pregen_stats["consumer_lag"][f"{record.topic}-{record.partition}"] = lag
+                    if lag > pregen_max_lag:
+                        print(f"[Pregen] Consumer lag {lag} on {record.topic}-{record.partition} exceeds {pregen_max_lag}")
+
+            try:
+                event = json.loads(record.value)
+                booking_id = int(event["bookingId"])
+            except Exception as e:
+                print(f"[Pregen] Ignoring malformed booking event: {e}")
+                pregen_stats["events_skipped"] += 1
+                await commit_pregen_offset(tp)
+                continue
+
+            if event.get("event") not in pregen_events:
+                pregen_stats["events_skipped"] += 1
+                await commit_pregen_offset(tp)
+                continue
+
+            # Blocks when the queue is full so the consumer stops reading ahead
+            offsets["pending"].add(record.offset)
+            await pregen_queue.put((tp, record.offset, booking_id))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"[Pregen] Booking event consumer stopped: {e}")
+
+async def wait_for_pregen_slot():
+    """Hold jobs back while interactive requests are busy or the LLM circuit is not closed"""
+    while (llm_breaker.state != "closed"
+           or (pregen_max_interactive and pregen_stats["interactive_in_flight"] >= pregen_max_interactive)):
+        await asyncio.sleep(0.5)
+
+async def run_pregen_worker():
+    """Generate queued plans at lower priority than interactive requests"""
+    while True:
+        tp, offset, booking_id = await pregen_queue.get()
+        try:
+            while True:
+                # Half-open probes are left to interactive requests
+                await wait_for_pregen_slot()
+                try:
+                    with track_request(f"pregen booking {booking_id}"):
+                        await pregenerate_plan(booking_id)
+                    break
+                except LLMUnavailable as e:
+                    # Keep the event until the LLM is back rather than storing a basic plan
+                    print(f"[Pregen] {e}, retrying")
+                    await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            # Leave the offset uncommitted so the interrupted event is redelivered
+            pregen_queue.task_done()
+            raise
+        except Exception as e:
+            pregen_stats["plans_failed"] += 1
+            print(f"[Pregen] Error pre-generating plan for booking {booking_id}: {e}")
+
+        # Only commit once the job is done, so events queued at shutdown are redelivered
+        pregen_offsets[tp]["pending"].discard(offset)
+        await commit_pregen_offset(tp)
+        pregen_queue.task_done()
+
+async def start_pregen(consumer):
+    """Start the booking-event consumer and its pre-generation workers"""
+    global pregen_queue, pregen_consumer
+    pregen_queue = asyncio.Queue(maxsize=pregen_queue_size)
+    pregen_consumer = consumer
+    pregen_offsets.clear()
+    pregen_tasks.append(asyncio.create_task(run_pregen_consumer(consumer)))
+    for _ in range(pregen_concurrency):
+        pregen_tasks.append(asyncio.create_task(run_pregen_worker()))
+
+async def stop_pregen():
+    """Cancel the pre-generation tasks"""
+    for task in pregen_tasks:
+        task.cancel()
+    await asyncio.gather(*pregen_tasks, return_exceptions=True)
+    pregen_tasks.clear()
+
+def pregen_running():
+    """Whether the consumer and all workers are still running"""
+    return bool(pregen_tasks) and all(not task.done() for task in pregen_tasks)
+
+@app.on_event("startup")
+async def start_booking_consumer():
+    """Subscribe to booking events when pre-generation is enabled"""
+    if not pregen_enabled:
+        return
+    if not AIOKafkaConsumer:
+        print("Warning: AI_PREGEN_ENABLED is set but aiokafka is not installed")
+        return
+    if not llm:
+        print("Warning: AI_PREGEN_ENABLED is set but OpenAI is not configured")
+        return
+
+    try:
+        consumer = AIOKafkaConsumer(
+            kafka_booking_topic,
+            bootstrap_servers=kafka_brokers,
+            group_id=pregen_group_id,
+            enable_auto_commit=False
+        )
+        await consumer.start()
+    except Exception as e:
+        print(f"Warning: Could not start Kafka consumer: {e}")
+        return
+
+    app.state.booking_consumer = consumer
+    await start_pregen(consumer)
+    print(f"[Pregen] Consuming {kafka_booking_topic} from {', '.join(kafka_brokers)}")
+
+@app.on_event("shutdown")
+async def stop_booking_consumer():
+    """Stop pre-generation and close the Kafka consumer"""
+    await stop_pregen()
+    consumer = getattr(app.state, "booking_consumer", None)
+    if consumer:
+        await consumer.stop()
+
+@app.get("/api/agent/pregen/stats")
+async def pregen_status():
+    """Pre-generation throughput, lag and priority counters"""
+    now = time.time()
+    return {
+        **pregen_stats,
+        "enabled": pregen_running(),
+        "queue_depth": pregen_queue.qsize() if pregen_queue else 0,
+        "plans_last_minute": sum(1 for t in pregen_completed_at if now - t <= 60),
+        "concurrency": pregen_concurrency,
+        "max_interactive": pregen_max_interactive,
+        "max_lag": pregen_max_lag
+    }
+
+# Diagnostics (off unless AI_DEBUG_ENABLED=true and AI_DEBUG_TOKEN is set)
+debug_enabled = os.getenv("AI_DEBUG_ENABLED", "false").lower() == "true"
+debug_token = os.getenv("AI_DEBUG_TOKEN", "")
+profile_interval = float(os.getenv("AI_PROFILE_INTERVAL_MS", "10")) / 1000
+profile_max_seconds = int(os.getenv("AI_PROFILE_MAX_SECONDS", "60"))
+tracemalloc_frames = int(os.getenv("AI_TRACEMALLOC_FRAMES", "10"))
+loop_lag_interval = float(os.getenv("AI_LOOP_LAG_INTERVAL", "0.5"))
+slow_callback_threshold = float(os.getenv("AI_SLOW_CALLBACK_THRESHOLD", "0.25"))
+
+profile_lock = threading.Lock()
+memory_baseline = None
+loop_stats = {"lag": 0.0, "max_lag": 0.0, "slow_callbacks": deque(maxlen=50)}
+loop_heartbeat = {"at": None, "thread_id": None}
+loop_monitor_stop = threading.Event()
+
+def require_debug_access(x_debug_token: Optional[str] = Header(None)):
+    """Hide the diagnostics endpoints unless enabled, and require the debug token"""
+    if not debug_enabled or not debug_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_debug_token or not hmac.compare_digest(x_debug_token.encode(), debug_token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid debug token")
+
+def frame_stack(frame):
+    """Folded stack for a frame, outermost call first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+def sample_stacks(seconds: float):
+    """Sample every thread's stack and count identical folded stacks"""
+    counts = {}
+    own_id = threading.get_ident()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            key = f"{names.get(thread_id, thread_id)};{frame_stack(frame)}"
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(profile_interval)
+    return counts
+
+@app.get("/debug/profile", dependencies=[Depends(require_debug_access)])
+async def debug_profile(seconds: int = 10):
+    """Sample live traffic and return folded stacks for flamegraph.pl or speedscope"""
+    seconds = max(1, min(seconds, profile_max_seconds))
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        counts = await asyncio.to_thread(sample_stacks, seconds)
+    finally:
+        profile_lock.release()
+    lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+def top_allocations(stats, limit: int):
+    """Serialize the largest tracemalloc statistics"""
+    return [
+        {
+            "location": str(stat.traceback),
+            "size_bytes": stat.size,
+            "size_diff_bytes": getattr(stat, "size_diff", None),
+            "count": stat.count,
+            "count_diff": getattr(stat, "count_diff", None)
+        }
+        for stat in stats[:limit]
+    ]
+
+def take_snapshot():
+    """Snapshot traced allocations, leaving out tracemalloc's own"""
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ])
+
+@app.post("/debug/memory/snapshot", dependencies=[Depends(require_debug_access)])
+async def debug_memory_snapshot(limit: int = 25):
+    """Start allocation tracking if needed and store a baseline snapshot"""
+    global memory_baseline
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(tracemalloc_frames)
+    memory_baseline = take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing_started": started,
+        "traced_current_bytes": current,
+        "traced_peak_bytes": peak,
+        "top": top_allocations(memory_baseline.statistics("lineno"), limit)
     }
 
+@app.get("/debug/memory/diff", dependencies=[Depends(require_debug_access)])
+async def debug_memory_diff(limit: int = 25):
+    """Allocation growth since the baseline snapshot"""
+    if memory_baseline is None or not tracemalloc.is_tracing():
+        raise HTTPException(status_code=400, detail="Take a snapshot first")
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_current_bytes": current,
+        "traced_peak_bytes": peak,
+        "top": top_allocations(take_snapshot().compare_to(memory_baseline, "lineno"), limit)
+    }
+
+@app.post("/debug/memory/stop", dependencies=[Depends(require_debug_access)])
+async def debug_memory_stop():
+    """Stop allocation tracking and drop the baseline"""
+    global memory_baseline
+    memory_baseline = None
+    tracemalloc.stop()
+    return {"tracing": False}
+
+async def monitor_loop_lag():
+    """Measure how late the event loop wakes us up"""
+    loop_heartbeat["thread_id"] = threading.get_ident()
+    while True:
+        t0 = time.monotonic()
+        loop_heartbeat["at"] = t0
+        await asyncio.sleep(loop_lag_interval)
+        lag = max(time.monotonic() - t0 - loop_lag_interval, 0.0)
+        loop_stats["lag"] = lag
+        loop_stats["max_lag"] = max(loop_stats["max_lag"], lag)
+
+def report_loop_stall(reported_beat):
+    """Record the loop thread's stack if it has missed a heartbeat; returns the beat reported"""
+    beat = loop_heartbeat["at"]
+    if beat is None or beat == reported_beat:
+        return reported_beat
+    blocked_for = time.monotonic() - beat - loop_lag_interval
+    if blocked_for < slow_callback_threshold:
+        return reported_beat
+    frame = sys._current_frames().get(loop_heartbeat["thread_id"])
+    if frame is None:
+        return reported_beat
+    loop_stats["slow_callbacks"].append({
+        "at": datetime.now().isoformat(),
+        "blocked_for_seconds": round(blocked_for, 3),
+        "requests": [entry["label"] for entry in list(in_flight_requests.values())],
+        "stack": frame_stack(frame).split(";")
+    })
+    print(f"[Debug] Event loop blocked for {blocked_for:.2f}s")
+    return beat
+
+def watch_loop_stalls():
+    """Capture the event loop's stack while a callback blocks it"""
+    reported_beat = None
+    while not loop_monitor_stop.wait(loop_lag_interval / 2):
+        # One bad sample must not stop the watchdog for the rest of the process
+        try:
+            reported_beat = report_loop_stall(reported_beat)
+        except Exception as e:
+            print(f"[Debug] Loop watchdog sample failed: {e}")
+
+@app.get("/debug/loop", dependencies=[Depends(require_debug_access)])
+async def debug_loop():
+    """Event loop lag and recent slow callback reports"""
+    return {
+        "lag_seconds": round(loop_stats["lag"], 4),
+        "max_lag_seconds": round(loop_stats["max_lag"], 4),
+        "slow_callback_threshold": slow_callback_threshold,
+        "slow_callbacks": list(loop_stats["slow_callbacks"])
+    }
+
+@app.get("/debug/requests", dependencies=[Depends(require_debug_access)])
+async def debug_requests():
+    """In-flight requests and the stage each one is in"""
+    now = time.monotonic()
+    return {
+        "requests": [
+            {
+                "id": entry["id"],
+                "label": entry["label"],
+                "stage": entry["stage"],
+                "started_at": datetime.fromtimestamp(entry["started_at"]).isoformat(),
+                "elapsed_seconds": round(now - entry["started"], 3)
+            }
+            for entry in list(in_flight_requests.values())
+        ]
+    }
+
+@app.on_event("startup")
+async def start_diagnostics():
+    """Start event loop monitoring when diagnostics are enabled"""
+    if not debug_enabled:
+        return
+    if not debug_token:
+        print("Warning: AI_DEBUG_ENABLED is set but AI_DEBUG_TOKEN is empty; diagnostics stay off")
+        return
+    app.state.loop_monitor = asyncio.create_task(monitor_loop_lag())
+    threading.Thread(target=watch_loop_stalls, name="loop-watchdog", daemon=True).start()
+    print("[Debug] Diagnostics endpoints enabled")
+
+@app.on_event("shutdown")
+async def stop_diagnostics():
+    """Stop event loop monitoring"""
+    loop_monitor_stop.set()
+    monitor = getattr(app.state, "loop_monitor", None)
+    if monitor:
+        monitor.cancel()
+
 if __name__ == "__main__":
     import uvicorn
-    from datetime import timedelta
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
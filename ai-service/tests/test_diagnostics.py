@@ -0,0 +1,121 @@
+# Debug endpoint auth, profiling, memory snapshots and the event loop watchdog
+import asyncio
+import threading
+import time
+import tracemalloc
+
+import pytest
+from fastapi import HTTPException
+
+import ai_agent
+
+
+@pytest.fixture
+def debug_on(monkeypatch):
+    monkeypatch.setattr(ai_agent, "debug_enabled", True)
+    monkeypatch.setattr(ai_agent, "debug_token", "s3cret")
+
+
+@pytest.mark.parametrize("token", [None, "wrong", "sécret"])
+def test_bad_debug_token_is_rejected(debug_on, token):
+    with pytest.raises(HTTPException) as exc:
+        ai_agent.require_debug_access(token)
+    assert exc.value.status_code == 401
+
+
+def test_debug_endpoints_hidden_when_disabled(monkeypatch):
+    monkeypatch.setattr(ai_agent, "debug_enabled", False)
+    with pytest.raises(HTTPException) as exc:
+        ai_agent.require_debug_access("s3cret")
+    assert exc.value.status_code == 404
+
+
+def test_loop_stall_is_reported_with_in_flight_requests(monkeypatch):
+    monkeypatch.setattr(ai_agent, "loop_lag_interval", 0.1)
+    monkeypatch.setattr(ai_agent, "slow_callback_threshold", 0.05)
+    ai_agent.loop_stats["slow_callbacks"].clear()
+    beat = time.monotonic() - 1
+    monkeypatch.setitem(ai_agent.loop_heartbeat, "at", beat)
+    monkeypatch.setitem(ai_agent.loop_heartbeat, "thread_id", threading.get_ident())
+
+    with ai_agent.track_request("POST /api/agent/plan"):
+        assert ai_agent.report_loop_stall(None) == beat
+        # The same stall is only reported once
+        assert ai_agent.report_loop_stall(beat) == beat
+
+    (report,) = ai_agent.loop_stats["slow_callbacks"]
+    assert report["requests"] == ["POST /api/agent/plan"]
+    assert report["blocked_for_seconds"] >= 0.8
+    assert any("test_loop_stall_is_reported" in frame for frame in report["stack"])
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture
+def busy_thread(monkeypatch):
+    monkeypatch.setattr(ai_agent, "profile_interval", 0.005)
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,), name="busy-worker")
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+def test_sample_stacks_folds_thread_stacks(busy_thread):
+    counts = ai_agent.sample_stacks(0.05)
+
+    busy = {stack: count for stack, count in counts.items() if stack.startswith("busy-worker;")}
+    assert busy
+    for stack in busy:
+        frames = stack.split(";")
+        assert frames[-1].startswith("spin (test_diagnostics.py:")
+        assert frames[1].startswith("_bootstrap (threading.py:")
+
+
+def test_concurrent_profile_is_rejected(busy_thread):
+    async def scenario():
+        return await asyncio.gather(ai_agent.debug_profile(seconds=1), ai_agent.debug_profile(seconds=1),
+                                    return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    (rejected,) = [r for r in results if isinstance(r, HTTPException)]
+    (profile,) = [r for r in results if not isinstance(r, HTTPException)]
+    assert rejected.status_code == 409
+
+    lines = profile.body.decode().splitlines()
+    counts = [int(line.rsplit(" ", 1)[1]) for line in lines]
+    assert counts == sorted(counts, reverse=True)
+    assert any(line.startswith("busy-worker;") for line in lines)
+
+
+def test_memory_snapshot_diff_and_stop(monkeypatch):
+    monkeypatch.setattr(ai_agent, "memory_baseline", None)
+    tracemalloc.stop()
+
+    async def scenario():
+        with pytest.raises(HTTPException) as exc:
+            await ai_agent.debug_memory_diff()
+        assert exc.value.status_code == 400
+
+        snapshot = await ai_agent.debug_memory_snapshot()
+        leak = [bytes(1024) for _ in range(200)]
+        diff = await ai_agent.debug_memory_diff(limit=5)
+        stopped = await ai_agent.debug_memory_stop()
+        del leak
+        return snapshot, diff, stopped
+
+    try:
+        snapshot, diff, stopped = asyncio.run(scenario())
+    finally:
+        tracemalloc.stop()
+
+    assert snapshot["tracing_started"]
+    assert diff["top"][0]["size_diff_bytes"] >= 200 * 1024
+    assert stopped == {"tracing": False}
+    assert not tracemalloc.is_tracing()
+    assert ai_agent.memory_baseline is None
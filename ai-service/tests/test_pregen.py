@@ -0,0 +1,259 @@
+# Booking-event pre-generation, driven by an in-memory stand-in for the Kafka consumer
+import asyncio
+import json
+import time
+from collections import namedtuple
+from datetime import date
+
+import pytest
+
+import ai_agent
+
+Record = namedtuple("Record", ["topic", "partition", "offset", "value"])
+
+TOPIC = "booking-notifications"
+
+BOOKING = {
+    "id": 7,
+    "status": "ACCEPTED",
+    "location": "Lisbon",
+    "start_date": date(2026, 11, 1),
+    "end_date": date(2026, 11, 3),
+    "number_of_guests": 2,
+}
+
+LLM_PLAN = {
+    "days": [
+        {
+            "day": 1,
+            "morning": {"title": "Belem Tower", "address": "Belem"},
+            "afternoon": {"title": "LX Factory", "address": "Alcantara"},
+            "evening": {"title": "Time Out Market", "address": "Cais do Sodre"},
+        }
+    ],
+    "restaurants": [{"name": "Cervejaria Ramiro", "cuisine": "Seafood", "address": "Intendente"}],
+    "packing": ["Walking shoes"],
+    "summary": "Two days in Lisbon",
+}
+
+
+class FakeConsumer:
+    """Local broker stand-in: yields the given records and reports a fixed high-water mark"""
+
+    def __init__(self, records, highwater):
+        self.records = records
+        self._highwater = highwater
+        self.commits = []
+
+    async def __aiter__(self):
+        for record in self.records:
+            yield record
+
+    def highwater(self, tp):
+        return self._highwater
+
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+
+class FakeLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        return type("Response", (), {"content": json.dumps(LLM_PLAN)})()
+
+
+def event(offset, name="booking_accepted", booking_id=7):
+    value = json.dumps({"event": name, "bookingId": booking_id}).encode()
+    return Record(TOPIC, 0, offset, value)
+
+
+@pytest.fixture
+def pregen(monkeypatch):
+    """Reset pre-generation state and stub the database and LLM"""
+    for key in ai_agent.pregen_stats:
+        ai_agent.pregen_stats[key] = {} if key == "consumer_lag" else 0
+    ai_agent.pregen_completed_at.clear()
+    ai_agent.llm_breaker.record_success()
+
+    saved = []
+    llm = FakeLLM()
+    monkeypatch.setattr(ai_agent, "llm", llm)
+    monkeypatch.setattr(ai_agent, "get_booking_details", lambda booking_id: dict(BOOKING, id=booking_id))
+    monkeypatch.setattr(ai_agent, "get_stored_plan", lambda booking_id, cache_key: None)
+    monkeypatch.setattr(ai_agent, "save_trip_plan",
+                        lambda booking_id, cache_key, plan: saved.append((booking_id, plan)) or True)
+    return {"saved": saved, "llm": llm}
+
+
+async def consume(consumer):
+    """Run the consumer to the end of its records and wait for the workers to finish"""
+    await ai_agent.start_pregen(consumer)
+    try:
+        await asyncio.wait_for(ai_agent.pregen_tasks[0], 5)
+        await asyncio.wait_for(ai_agent.pregen_queue.join(), 5)
+        return await ai_agent.pregen_status()
+    finally:
+        await ai_agent.stop_pregen()
+
+
+def test_malformed_and_unlisted_events_are_skipped(pregen):
+    records = [
+        Record(TOPIC, 0, 0, b"not json"),
+        Record(TOPIC, 0, 1, json.dumps({"event": "booking_created"}).encode()),
+        event(2, name="booking_cancelled"),
+    ]
+    consumer = FakeConsumer(records, highwater=3)
+
+    stats = asyncio.run(consume(consumer))
+
+    assert stats["events_consumed"] == 3
+    assert stats["events_skipped"] == 3
+    assert pregen["saved"] == []
+    assert consumer.commits[-1] == {ai_agent.TopicPartition(TOPIC, 0): 3}
+
+
+def test_cancelled_booking_is_skipped(pregen, monkeypatch):
+    monkeypatch.setattr(ai_agent, "get_booking_details",
+                        lambda booking_id: dict(BOOKING, id=booking_id, status="CANCELLED"))
+
+    stats = asyncio.run(consume(FakeConsumer([event(0)], highwater=1)))
+
+    assert stats["events_skipped"] == 1
+    assert pregen["saved"] == []
+    assert pregen["llm"].calls == 0
+
+
+def test_plan_is_saved(pregen):
+    consumer = FakeConsumer([event(0, booking_id=7)], highwater=1)
+
+    stats = asyncio.run(consume(consumer))
+
+    assert stats["plans_generated"] == 1
+    assert len(pregen["saved"]) == 1
+    booking_id, plan = pregen["saved"][0]
+    assert booking_id == 7
+    assert plan.day_plans[0].morning[0].title == "Belem Tower"
+    assert consumer.commits[-1] == {ai_agent.TopicPartition(TOPIC, 0): 1}
+
+
+def test_job_cancelled_at_shutdown_is_not_committed(pregen, monkeypatch):
+    def slow_booking(booking_id):
+        time.sleep(0.2)
+        return dict(BOOKING, id=booking_id)
+
+    monkeypatch.setattr(ai_agent, "get_booking_details", slow_booking)
+    consumer = FakeConsumer([event(0)], highwater=1)
+
+    async def scenario():
+        await ai_agent.start_pregen(consumer)
+        await asyncio.wait_for(ai_agent.pregen_tasks[0], 5)
+        await asyncio.sleep(0.05)
+        await ai_agent.stop_pregen()
+
+    asyncio.run(scenario())
+
+    assert ai_agent.pregen_stats["plans_generated"] == 0
+    assert consumer.commits == []
+    assert ai_agent.pregen_offsets[ai_agent.TopicPartition(TOPIC, 0)]["pending"] == {0}
+
+
+def test_lag_and_queue_depth_are_reported(pregen, monkeypatch):
+    monkeypatch.setattr(ai_agent, "pregen_concurrency", 0)
+
+    async def scenario():
+        await ai_agent.start_pregen(FakeConsumer([event(4), event(5)], highwater=10))
+        try:
+            await asyncio.wait_for(ai_agent.pregen_tasks[0], 5)
+            return await ai_agent.pregen_status()
+        finally:
+            await ai_agent.stop_pregen()
+
+    stats = asyncio.run(scenario())
+
+    assert stats["consumer_lag"] == {f"{TOPIC}-0": 4}
+    assert stats["queue_depth"] == 2
+
+
+def test_worker_waits_for_interactive_requests(pregen, monkeypatch):
+    monkeypatch.setattr(ai_agent, "pregen_max_interactive", 1)
+
+    async def scenario():
+        ai_agent.pregen_stats["interactive_in_flight"] = 1
+        await ai_agent.start_pregen(FakeConsumer([event(0)], highwater=1))
+        try:
+            await asyncio.wait_for(ai_agent.pregen_tasks[0], 5)
+            await asyncio.sleep(0.7)
+            waiting = (pregen["llm"].calls, ai_agent.pregen_queue._unfinished_tasks)
+
+            ai_agent.pregen_stats["interactive_in_flight"] = 0
+            await asyncio.wait_for(ai_agent.pregen_queue.join(), 5)
+            return waiting
+        finally:
+            await ai_agent.stop_pregen()
+
+    calls, unfinished = asyncio.run(scenario())
+
+    assert (calls, unfinished) == (0, 1)
+    assert pregen["llm"].calls == 1
+    assert len(pregen["saved"]) == 1
+
+
+def test_event_is_held_while_llm_is_unavailable(pregen, monkeypatch):
+    class FailingLLM:
+        calls = 0
+
+        async def ainvoke(self, messages):
+            self.calls += 1
+            raise RuntimeError("OpenAI is down")
+
+    failing = FailingLLM()
+    monkeypatch.setattr(ai_agent, "llm", failing)
+    consumer = FakeConsumer([event(0)], highwater=1)
+
+    async def scenario():
+        await ai_agent.start_pregen(consumer)
+        try:
+            await asyncio.wait_for(ai_agent.pregen_tasks[0], 5)
+            for _ in range(50):
+                if ai_agent.llm_breaker.state == "open":
+                    break
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.6)
+            held = (ai_agent.llm_breaker.state, failing.calls, list(consumer.commits))
+
+            # An interactive request closes the circuit again
+            ai_agent.llm = pregen["llm"]
+            ai_agent.llm_breaker.record_success()
+            await asyncio.wait_for(ai_agent.pregen_queue.join(), 5)
+            return held
+        finally:
+            await ai_agent.stop_pregen()
+
+    state, calls, commits = asyncio.run(scenario())
+
+    assert (state, calls, commits) == ("open", ai_agent.llm_breaker.failure_threshold, [])
+    assert ai_agent.pregen_stats["plans_failed"] == 0
+    assert ai_agent.pregen_stats["plans_generated"] == 1
+    assert consumer.commits[-1] == {ai_agent.TopicPartition(TOPIC, 0): 1}
+
+
+def test_serve_travel_plan_returns_stored_plan(pregen, monkeypatch):
+    stored = ai_agent.AgentResponse(day_plans=[], restaurant_recommendations=[],
+                                    packing_checklist=["Passport"], summary="Stored plan")
+    monkeypatch.setattr(ai_agent, "get_stored_plan", lambda booking_id, cache_key: stored)
+    request = ai_agent.AgentRequestModel(
+        booking_context=ai_agent.BookingContextModel(
+            booking_id=7, location="Lisbon", start_date="2026-11-01",
+            end_date="2026-11-03", number_of_guests=2
+        ),
+        preferences=ai_agent.PreferencesModel()
+    )
+
+    plan = asyncio.run(ai_agent.serve_travel_plan(request))
+
+    assert plan is stored
+    assert pregen["llm"].calls == 0
+    assert ai_agent.pregen_stats["cache_hits"] == 1
@@ -0,0 +1,236 @@
+# Request deadlines, DB timeouts and circuit breakers for upstream calls
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import ai_agent
+
+
+class FakeRequest:
+    def __init__(self, headers, disconnected=False):
+        self.headers = headers
+        self.method = "POST"
+        self.url = type("URL", (), {"path": "/api/agent/query"})()
+        self.disconnected = disconnected
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+class FakeSearch:
+    """Tavily stand-in; each attempt sleeps for its delay, then returns or raises its outcome"""
+
+    def __init__(self, *attempts):
+        self.attempts = attempts
+        self.calls = 0
+        self.cancelled = []
+
+    async def ainvoke(self, payload):
+        attempt = self.calls
+        self.calls += 1
+        delay, outcome = self.attempts[attempt]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(attempt)
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class FailingLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        raise RuntimeError("OpenAI is down")
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    """Fresh circuits so earlier failures don't leak between tests"""
+    llm_breaker = ai_agent.CircuitBreaker("openai", failure_threshold=3, reset_timeout=30)
+    search_breaker = ai_agent.CircuitBreaker("tavily", failure_threshold=3, reset_timeout=30)
+    monkeypatch.setattr(ai_agent, "llm_breaker", llm_breaker)
+    monkeypatch.setattr(ai_agent, "search_breaker", search_breaker)
+    return llm_breaker, search_breaker
+
+
+def test_half_open_breaker_allows_a_single_probe():
+    breaker = ai_agent.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = ai_agent.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_slow_db_call_returns_fallback(monkeypatch):
+    monkeypatch.setattr(ai_agent, "db_timeout", 0.05)
+
+    def slow_history(user_id, limit=10):
+        time.sleep(0.2)
+        return ["late"]
+
+    assert asyncio.run(ai_agent.call_db(slow_history, 1, limit=10, fallback=[])) == []
+
+
+def test_db_call_past_deadline_raises(monkeypatch):
+    monkeypatch.setattr(ai_agent, "db_timeout", 5)
+
+    async def scenario():
+        ai_agent.request_deadline.set(time.monotonic() + 0.05)
+        return await ai_agent.call_db(time.sleep, 0.2)
+
+    with pytest.raises(ai_agent.DeadlineExceeded):
+        asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("2000", 2.0),
+    ("999999999", 55.0),
+    ("0", 55.0),
+    ("-5", 55.0),
+    ("soon", 55.0),
+])
+def test_timeout_header_can_only_shorten_budget(monkeypatch, header, expected):
+    monkeypatch.setattr(ai_agent, "request_timeout_ms", 55000)
+
+    async def handler():
+        return ai_agent.remaining_budget()
+
+    async def scenario():
+        return await ai_agent.run_interactive(FakeRequest({"x-request-timeout-ms": header}), handler())
+
+    assert asyncio.run(scenario()) == pytest.approx(expected, abs=0.5)
+
+
+def query_request(user_id=None):
+    return ai_agent.AgentRequestModel(
+        booking_context=ai_agent.BookingContextModel(
+            booking_id=7, location="Lisbon", start_date="2026-11-01",
+            end_date="2026-11-03", number_of_guests=2
+        ),
+        preferences=ai_agent.PreferencesModel(),
+        custom_query="Where should we eat?",
+        user_id=user_id
+    )
+
+
+def test_query_skips_upstream_work_while_probe_is_held(monkeypatch):
+    breaker = ai_agent.CircuitBreaker("openai", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    assert breaker.probe_in_flight and not breaker.available
+
+    def unexpected(*args, **kwargs):
+        raise AssertionError("should not be called while the probe is held")
+
+    monkeypatch.setattr(ai_agent, "llm_breaker", breaker)
+    monkeypatch.setattr(ai_agent, "llm", object())
+    monkeypatch.setattr(ai_agent, "get_conversation_history", unexpected)
+    monkeypatch.setattr(ai_agent, "hedged_search", unexpected)
+
+    result = asyncio.run(ai_agent.answer_custom_query(query_request(user_id=3)))
+
+    assert "currently unavailable" in result["response"]
+
+
+def test_hedge_returns_result_after_failed_attempt(breakers, monkeypatch):
+    search = FakeSearch((0, RuntimeError("502 from Tavily")), (0, ["Time Out Market"]))
+    monkeypatch.setattr(ai_agent, "search_tool", search)
+
+    assert asyncio.run(ai_agent.hedged_search("food in Lisbon")) == ["Time Out Market"]
+    assert search.calls == 2
+
+
+def test_fast_hedge_wins_and_slow_attempt_is_cancelled(breakers, monkeypatch):
+    monkeypatch.setattr(ai_agent, "search_hedge_delay", 0.05)
+    search = FakeSearch((1, ["slow"]), (0, ["fast"]))
+    monkeypatch.setattr(ai_agent, "search_tool", search)
+
+    async def scenario():
+        result = await ai_agent.hedged_search("food in Lisbon")
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == ["fast"]
+    assert search.cancelled == [0]
+
+
+def test_failed_hedges_return_none_and_count_one_failure(breakers, monkeypatch):
+    _, search_breaker = breakers
+    search = FakeSearch((0, RuntimeError("timeout")), (0, RuntimeError("timeout")))
+    monkeypatch.setattr(ai_agent, "search_tool", search)
+
+    assert asyncio.run(ai_agent.hedged_search("food in Lisbon")) is None
+    assert search.calls == 2
+    assert search_breaker.failures == 1
+
+
+def test_open_llm_circuit_falls_back_to_basic_answers(breakers, monkeypatch):
+    llm_breaker, _ = breakers
+    failing = FailingLLM()
+    monkeypatch.setattr(ai_agent, "llm", failing)
+    monkeypatch.setattr(ai_agent, "search_tool", None)
+
+    async def scenario():
+        for _ in range(llm_breaker.failure_threshold):
+            await ai_agent.handle_custom_query(query_request(), FakeRequest({}))
+        plan = await ai_agent.create_travel_plan(query_request(), FakeRequest({}))
+        answer = await ai_agent.handle_custom_query(query_request(), FakeRequest({}))
+        return plan, answer
+
+    plan, answer = asyncio.run(scenario())
+
+    assert llm_breaker.state == "open"
+    assert failing.calls == llm_breaker.failure_threshold
+    assert plan.day_plans == []
+    assert plan.summary == "Your 2-day trip to Lisbon"
+    assert "currently unavailable" in answer["response"]
+
+
+def test_disconnected_client_cancels_handler(monkeypatch):
+    monkeypatch.setattr(ai_agent, "disconnect_poll_interval", 0.01)
+    cancelled = []
+
+    async def handler():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        try:
+            await ai_agent.run_interactive(FakeRequest({}, disconnected=True), handler())
+        finally:
+            await asyncio.sleep(0)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+
+    assert exc.value.status_code == 499
+    assert cancelled == [True]
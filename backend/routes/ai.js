@@ -7,6 +7,10 @@ const router = express.Router();
 // AI Service URL from environment variable
 const AI_SERVICE_URL = process.env.AI_SERVICE_URL || 'http://ai-service:8000';
 
+// Time budget passed to the AI service so it stops upstream calls before our proxy timeout
+const AI_PROXY_TIMEOUT_MS = 60000;
+const AI_REQUEST_BUDGET_MS = AI_PROXY_TIMEOUT_MS - 5000;
+
 /**
  * Proxy endpoint for AI plan generation
  * POST /api/ai/plan
@@ -16,8 +20,9 @@ router.post('/plan', async (req, res) => {
     const response = await axios.post(`${AI_SERVICE_URL}/api/agent/plan`, req.body, {
       headers: {
         'Content-Type': 'application/json',
+        'X-Request-Timeout-Ms': String(AI_REQUEST_BUDGET_MS),
       },
-      timeout: 60000, // 60 second timeout for AI processing
+      timeout: AI_PROXY_TIMEOUT_MS, // 60 second timeout for AI processing
     });
     res.json(response.data);
   } catch (error) {
@@ -50,8 +55,9 @@ router.post('/query', async (req, res) => {
     const response = await axios.post(`${AI_SERVICE_URL}/api/agent/query`, req.body, {
       headers: {
         'Content-Type': 'application/json',
+        'X-Request-Timeout-Ms': String(AI_REQUEST_BUDGET_MS),
       },
-      timeout: 60000, // 60 second timeout for AI processing
+      timeout: AI_PROXY_TIMEOUT_MS, // 60 second timeout for AI processing
     });
     res.json(response.data);
   } catch (error) {
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS ai_trip_plans (
+    booking_id INT NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    plan_json MEDIUMTEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (booking_id, request_hash),
+    FOREIGN KEY (booking_id) REFERENCES bookings(id) ON DELETE CASCADE
+);